@@ -0,0 +1,19 @@
+"""Import backend/server.py for unit tests, without Azure credentials or a running MongoDB"""
+import os
+import sys
+from unittest.mock import MagicMock, patch
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend")
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+# The MSAL client is built at import time and would try to reach the tenant
+with patch("msal.ConfidentialClientApplication", MagicMock()):
+    import server
+
+try:
+    from mongomock_motor import AsyncMongoMockClient
+except ImportError:
+    AsyncMongoMockClient = None
+
+__all__ = ["server", "AsyncMongoMockClient"]
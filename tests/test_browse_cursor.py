@@ -0,0 +1,40 @@
+import unittest
+
+from fastapi import HTTPException
+
+from tests.server_support import server
+
+PAGE_URL = f"{server.GRAPH_API_URL}/me/drive/items/F1/children?$skiptoken=abc"
+
+
+class TestBrowseCursor(unittest.TestCase):
+    """Continuation cursors only resume the folder listing and user they were issued for"""
+
+    def setUp(self):
+        self.owner = server.browse_cursor_owner("user-1")
+        self.cursor = server.encode_browse_cursor(PAGE_URL, 7, "F1", self.owner)
+
+    def assert_rejected(self, cursor: str, folder_id: str, owner: str):
+        with self.assertRaises(HTTPException) as raised:
+            server.decode_browse_cursor(cursor, folder_id, owner)
+        self.assertEqual(raised.exception.status_code, 400)
+
+    def test_round_trip(self):
+        self.assertEqual(server.decode_browse_cursor(self.cursor, "F1", self.owner), {"url": PAGE_URL, "offset": 7})
+
+    def test_other_folder(self):
+        self.assert_rejected(self.cursor, "F2", self.owner)
+
+    def test_other_user(self):
+        self.assert_rejected(self.cursor, "F1", server.browse_cursor_owner("user-2"))
+
+    def test_foreign_host(self):
+        cursor = server.encode_browse_cursor("https://example.com/steal", 0, "F1", self.owner)
+        self.assert_rejected(cursor, "F1", self.owner)
+
+    def test_garbage(self):
+        self.assert_rejected("not-a-cursor", "F1", self.owner)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+from unittest.mock import patch
+
+from tests.server_support import server
+
+
+class TestParseByteRanges(unittest.TestCase):
+    """Range header parsing (RFC 7233) for /api/stream"""
+
+    def test_single_range(self):
+        self.assertEqual(server.parse_byte_ranges("bytes=0-99", 1000), [(0, 99)])
+
+    def test_open_ended_range(self):
+        self.assertEqual(server.parse_byte_ranges("bytes=900-", 1000), [(900, 999)])
+
+    def test_end_is_clamped_to_file_size(self):
+        self.assertEqual(server.parse_byte_ranges("bytes=990-5000", 1000), [(990, 999)])
+
+    def test_suffix_range(self):
+        self.assertEqual(server.parse_byte_ranges("bytes=-100", 1000), [(900, 999)])
+        self.assertEqual(server.parse_byte_ranges("bytes=-5000", 1000), [(0, 999)])
+
+    def test_suffix_range_of_empty_file_is_unsatisfiable(self):
+        self.assertEqual(server.parse_byte_ranges("bytes=-100", 0), [])
+
+    def test_start_past_end_is_unsatisfiable(self):
+        self.assertEqual(server.parse_byte_ranges("bytes=1000-", 1000), [])
+
+    def test_malformed_headers_are_ignored(self):
+        for header in ("bytes=abc", "bytes=-", "bytes=5-2", "bytes=1-2-3", "items=0-10"):
+            with self.subTest(header=header):
+                self.assertIsNone(server.parse_byte_ranges(header, 1000))
+
+    def test_whitespace_and_empty_elements(self):
+        self.assertEqual(server.parse_byte_ranges(" Bytes = 0 - 9 , , ", 1000), [(0, 9)])
+
+    def test_overlapping_and_adjacent_ranges_coalesce(self):
+        ranges = server.parse_byte_ranges("bytes=500-599,0-99,100-199,150-250", 1000)
+        self.assertEqual(ranges, [(0, 250), (500, 599)])
+
+    def test_too_many_ranges_collapse_to_one_span(self):
+        header = "bytes=" + ",".join(f"{i * 10}-{i * 10 + 1}" for i in range(20))
+        with patch.object(server, "STREAM_MAX_RANGES", 4):
+            self.assertEqual(server.parse_byte_ranges(header, 1000), [(0, 191)])
+
+
+class TestIfRange(unittest.TestCase):
+    """If-Range validation against the ETag the stream endpoint sends"""
+
+    file_info = {"eTag": '"{3F2504E0-4F89-11D3-9A0C-0305E82C3301},3"', "lastModifiedDateTime": "2024-05-01T10:00:00Z"}
+
+    def test_graph_etag_is_sent_as_is(self):
+        self.assertEqual(server.entity_tag(self.file_info), self.file_info["eTag"])
+
+    def test_unquoted_etag_is_quoted(self):
+        self.assertEqual(server.entity_tag({"eTag": "abc"}), '"abc"')
+        self.assertIsNone(server.entity_tag({}))
+
+    def test_matching_etag(self):
+        self.assertTrue(server.if_range_matches(self.file_info["eTag"], self.file_info))
+
+    def test_double_quoted_etag_does_not_match(self):
+        self.assertFalse(server.if_range_matches(f'"{self.file_info["eTag"]}"', self.file_info))
+
+    def test_stale_etag(self):
+        self.assertFalse(server.if_range_matches('"{3F2504E0-4F89-11D3-9A0C-0305E82C3301},2"', self.file_info))
+
+    def test_weak_validator_never_matches(self):
+        self.assertFalse(server.if_range_matches(f'W/{self.file_info["eTag"]}', self.file_info))
+
+    def test_last_modified_date(self):
+        self.assertTrue(server.if_range_matches("2024-05-01T10:00:00Z", self.file_info))
+        self.assertFalse(server.if_range_matches("2024-04-01T10:00:00Z", self.file_info))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,165 @@
+import asyncio
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from tests.server_support import server
+
+
+class TestTTLCache(unittest.TestCase):
+    """Per-entry expiry and LRU bounds of the in-process cache"""
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = patch.object(server.time, "monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = server.TTLCache(max_entries=3, default_ttl=10)
+
+    def test_get_and_default(self):
+        self.cache.set("a", 1)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertEqual(self.cache.get("missing", "default"), "default")
+
+    def test_entries_expire(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2, ttl=30)
+        self.now += 10
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.get("b"), 2)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_non_positive_ttl_is_not_stored(self):
+        self.cache.set("a", 1, ttl=0)
+        self.assertIsNone(self.cache.get("a"))
+
+    def test_least_recently_used_is_evicted(self):
+        for key in "abc":
+            self.cache.set(key, key)
+        self.cache.get("a")
+        self.cache.set("d", "d")
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual([self.cache.get(key) for key in "acd"], ["a", "c", "d"])
+
+    def test_falsy_values_are_cached(self):
+        self.cache.set("a", 0)
+        self.assertEqual(self.cache.get("a", "default"), 0)
+
+    def test_pop(self):
+        self.cache.set("a", 1)
+        self.assertEqual(self.cache.pop("a"), 1)
+        self.assertIsNone(self.cache.pop("a"))
+
+
+class TestSingleFlight(unittest.IsolatedAsyncioTestCase):
+    """Concurrent callers of one key share a single task"""
+
+    async def asyncSetUp(self):
+        self.flights = server.SingleFlight()
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def fetch(self):
+        self.calls += 1
+        await self.release.wait()
+        return self.calls
+
+    async def test_concurrent_calls_share_one_fetch(self):
+        callers = [asyncio.create_task(self.flights.run("k", self.fetch)) for _ in range(5)]
+        await asyncio.sleep(0)
+        self.release.set()
+        self.assertEqual(await asyncio.gather(*callers), [1] * 5)
+        self.assertEqual(self.calls, 1)
+
+    async def test_finished_flight_is_forgotten(self):
+        self.release.set()
+        await self.flights.run("k", self.fetch)
+        await self.flights.run("k", self.fetch)
+        self.assertEqual(self.calls, 2)
+
+    async def test_different_keys_do_not_share(self):
+        self.release.set()
+        await asyncio.gather(self.flights.run("a", self.fetch), self.flights.run("b", self.fetch))
+        self.assertEqual(self.calls, 2)
+
+    async def test_cancelled_caller_leaves_the_fetch_running(self):
+        first = asyncio.create_task(self.flights.run("k", self.fetch))
+        second = asyncio.create_task(self.flights.run("k", self.fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+        self.release.set()
+        self.assertEqual(await second, 1)
+        self.assertTrue(first.cancelled())
+
+    async def test_errors_reach_every_caller(self):
+        async def fail():
+            await asyncio.sleep(0)
+            raise RuntimeError("upstream down")
+
+        results = await asyncio.gather(
+            self.flights.run("k", fail), self.flights.run("k", fail), return_exceptions=True
+        )
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in results))
+
+
+class TestMediaBlockCacheScan(unittest.IsolatedAsyncioTestCase):
+    """The startup scan indexes finished blocks and only clears abandoned partial writes"""
+
+    async def test_scan(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        version_dir = os.path.join(directory.name, "v1")
+        os.makedirs(version_dir)
+        for name in ("0.blk", "1.blk.aaaa.tmp", "2.blk.bbbb.tmp"):
+            with open(os.path.join(version_dir, name), "wb") as f:
+                f.write(b"x" * 10)
+        stale = time.time() - server.MEDIA_CACHE_TMP_GRACE - 1
+        os.utime(os.path.join(version_dir, "2.blk.bbbb.tmp"), (stale, stale))
+
+        cache = server.MediaBlockCache(directory.name, 1000)
+        await cache.load()
+        self.assertIn(("v1", 0), cache)
+        self.assertEqual(cache.total_bytes, 10)
+        # Another worker may still be writing the recent one
+        self.assertEqual(sorted(os.listdir(version_dir)), ["0.blk", "1.blk.aaaa.tmp"])
+
+
+class TestTimelineCache(unittest.IsolatedAsyncioTestCase):
+    """Timeline sprites live in a size-bounded LRU and are rebuilt once evicted"""
+
+    async def asyncSetUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache = server.MediaBlockCache(directory.name, 1000)
+        patcher = patch.object(server, "timeline_disk", self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def store(self, key: str, sprite: bytes):
+        await self.cache.put(key, server.TIMELINE_SPRITE_BLOCK, sprite)
+        await self.cache.put(key, server.TIMELINE_META_BLOCK, json.dumps({"key": key}).encode())
+
+    async def test_complete_sprite(self):
+        await self.store("a", b"x" * 100)
+        self.assertEqual(await server.read_timeline_meta("a"), {"key": "a"})
+
+    async def test_size_bound(self):
+        for key in "abcd":
+            await self.store(key, b"x" * 400)
+        self.assertLessEqual(self.cache.total_bytes, 1000)
+        self.assertIsNone(await server.read_timeline_meta("a"))
+        self.assertEqual(await server.read_timeline_meta("d"), {"key": "d"})
+
+    async def test_layout_without_sprite_is_a_miss(self):
+        await self.store("a", b"x" * 100)
+        # Another worker's eviction removed the image; the read notices and drops it
+        os.unlink(os.path.join(self.cache.root, "a", f"{server.TIMELINE_SPRITE_BLOCK}.blk"))
+        self.assertIsNone(await self.cache.get("a", server.TIMELINE_SPRITE_BLOCK))
+        self.assertIsNone(await server.read_timeline_meta("a"))
+
+
+if __name__ == "__main__":
+    unittest.main()
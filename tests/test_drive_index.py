@@ -0,0 +1,83 @@
+import unittest
+from unittest.mock import AsyncMock, patch
+
+from tests.server_support import AsyncMongoMockClient, server
+
+
+def folder(item_id: str, name: str, parent_id: str) -> dict:
+    return {"id": item_id, "name": name, "folder": {}, "parentReference": {"id": parent_id}}
+
+
+def file(item_id: str, name: str, parent_id: str) -> dict:
+    return {"id": item_id, "name": name, "size": 5, "file": {"mimeType": "video/mp4"}, "parentReference": {"id": parent_id}}
+
+
+@unittest.skipIf(AsyncMongoMockClient is None, "mongomock-motor is not installed")
+class TestApplyDeltaPage(unittest.IsolatedAsyncioTestCase):
+    """Materialized paths stay consistent as delta pages are applied"""
+
+    async def asyncSetUp(self):
+        self.db = AsyncMongoMockClient()["test"]
+        patcher = patch.object(server.app, "mongodb", self.db, create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.state = {}
+        await server.apply_delta_page("u1", [
+            {"id": "R", "name": "root", "root": {}},
+            folder("A", "Movies", "R"),
+            folder("B", "Action", "A"),
+        ], {}, self.state)
+        # A later page (and a later sync) only knows the root; parents come from Mongo
+        await server.apply_delta_page("u1", [file("f1", "x.mp4", "B")], {"R": ""}, self.state)
+
+    async def paths(self) -> dict:
+        cursor = self.db["drive_items"].find({"user_id": "u1"}, {"id": 1, "path": 1})
+        return {doc["id"]: doc["path"] async for doc in cursor}
+
+    async def test_initial_crawl(self):
+        self.assertEqual(self.state["root_id"], "R")
+        self.assertEqual(await self.paths(), {"A": "Movies", "B": "Movies/Action", "f1": "Movies/Action/x.mp4"})
+
+    async def apply_with_rewrites(self, user_id: str, items: list) -> list:
+        """Apply a page, capturing descendant rewrites (mongomock cannot run $substrCP pipelines)"""
+        collection_type = type(self.db["drive_items"])
+        with patch.object(collection_type, "update_many", AsyncMock()) as update_many:
+            await server.apply_delta_page(user_id, items, {"R": ""}, self.state)
+        return [call.args for call in update_many.await_args_list]
+
+    def assert_rewrite(self, rewrite: tuple, old_path: str, new_path: str):
+        query, pipeline = rewrite
+        self.assertEqual(query, {"user_id": "u1", "path": {"$regex": f"^{old_path}/"}})
+        new_value = pipeline[0]["$set"]["path"]["$concat"]
+        self.assertEqual(new_value[0], new_path)
+        self.assertEqual(new_value[1]["$substrCP"][1], len(old_path))
+
+    async def test_rename_rewrites_descendants(self):
+        rewrites = await self.apply_with_rewrites("u1", [folder("A", "Films", "R")])
+        self.assertEqual(len(rewrites), 1)
+        self.assert_rewrite(rewrites[0], "Movies", "Films")
+        self.assertEqual((await self.paths())["A"], "Films")
+
+    async def test_move_rewrites_descendants(self):
+        rewrites = await self.apply_with_rewrites("u1", [folder("C", "Archive", "R"), folder("B", "Action", "C")])
+        self.assertEqual(len(rewrites), 1)
+        self.assert_rewrite(rewrites[0], "Movies/Action", "Archive/Action")
+        self.assertEqual((await self.paths())["B"], "Archive/Action")
+
+    async def test_unchanged_folder_needs_no_rewrite(self):
+        self.assertEqual(await self.apply_with_rewrites("u1", [folder("A", "Movies", "R")]), [])
+
+    async def test_deleted_folder_takes_descendants(self):
+        await server.apply_delta_page("u1", [{"id": "B", "deleted": {}}], {"R": ""}, self.state)
+        self.assertEqual(await self.paths(), {"A": "Movies"})
+
+    async def test_other_users_are_untouched(self):
+        await server.apply_delta_page("u2", [{"id": "R2", "root": {}}, folder("A", "Mine", "R2")], {}, {})
+        await self.apply_with_rewrites("u1", [folder("A", "Films", "R"), {"id": "B", "deleted": {}}])
+        mine = await self.db["drive_items"].find_one({"user_id": "u2", "id": "A"})
+        self.assertEqual(mine["path"], "Mine")
+
+
+if __name__ == "__main__":
+    unittest.main()
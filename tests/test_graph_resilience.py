@@ -0,0 +1,170 @@
+import asyncio
+import time
+import unittest
+
+import httpx
+
+from tests.server_support import server
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    """Open/half-open/closed transitions of the Graph circuit breaker"""
+
+    def setUp(self):
+        self.breaker = server.CircuitBreaker(threshold=3, window=30, cooldown=15)
+
+    def expire_cooldown(self):
+        self.breaker.open_until = time.monotonic() - 1
+
+    def test_opens_after_threshold(self):
+        for _ in range(2):
+            self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.allow())
+        self.assertGreater(self.breaker.retry_after(), 14)
+
+    def test_retry_after_extends_cooldown(self):
+        for _ in range(3):
+            self.breaker.record_failure(retry_after=60)
+        self.assertGreater(self.breaker.retry_after(), 59)
+
+    def test_success_resets_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow())
+
+    def test_half_open_admits_one_trial(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.expire_cooldown()
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+
+    def test_successful_trial_closes(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.expire_cooldown()
+        self.breaker.allow()
+        self.breaker.record_success()
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_trial_reopens(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.expire_cooldown()
+        self.breaker.allow()
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.allow())
+
+    def test_released_trial_admits_the_next_one(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.expire_cooldown()
+        self.breaker.allow()
+        self.breaker.release_trial()
+        self.assertTrue(self.breaker.allow())
+
+
+class HangingTransport(httpx.AsyncBaseTransport):
+    """Never answers, like an upstream that stalls until the caller gives up"""
+
+    def __init__(self):
+        self.started = asyncio.Event()
+
+    async def handle_async_request(self, request):
+        self.started.set()
+        await asyncio.Event().wait()
+
+
+class TestResilientGraphTransport(unittest.IsolatedAsyncioTestCase):
+    """Retries, throttling and breaker bookkeeping around Graph calls"""
+
+    def make_client(self, transport: httpx.AsyncBaseTransport) -> tuple:
+        resilient = server.ResilientGraphTransport(transport)
+        client = httpx.AsyncClient(transport=resilient)
+        self.addAsyncCleanup(client.aclose)
+        return resilient, client
+
+    async def test_cancelled_trial_is_released(self):
+        transport = HangingTransport()
+        resilient, client = self.make_client(transport)
+        resilient.breaker.open_until = time.monotonic() - 1  # Cooldown just ended
+
+        request = asyncio.create_task(client.get("https://graph.microsoft.com/v1.0/me"))
+        await asyncio.wait_for(transport.started.wait(), 5)
+        self.assertTrue(resilient.breaker.half_open_trial)
+        request.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await request
+
+        self.assertFalse(resilient.breaker.half_open_trial)
+        self.assertTrue(resilient.breaker.allow())
+
+    async def test_failed_trial_reopens_the_breaker(self):
+        resilient, client = self.make_client(
+            httpx.MockTransport(lambda request: httpx.Response(503, headers={"Retry-After": "0"}))
+        )
+        resilient.breaker.open_until = time.monotonic() - 1
+        response = await client.get("https://graph.microsoft.com/v1.0/me")
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(resilient.breaker.allow())
+        self.assertGreater(resilient.breaker.retry_after(), 0)
+
+    async def test_successful_trial_closes_the_breaker(self):
+        resilient, client = self.make_client(httpx.MockTransport(lambda request: httpx.Response(200)))
+        resilient.breaker.open_until = time.monotonic() - 1
+        await client.get("https://graph.microsoft.com/v1.0/me")
+        self.assertEqual(resilient.breaker.open_until, 0)
+        self.assertTrue(resilient.breaker.allow())
+
+    async def test_throttled_trial_is_released(self):
+        resilient, client = self.make_client(
+            httpx.MockTransport(lambda request: httpx.Response(429, headers={"Retry-After": "0"}))
+        )
+        resilient.breaker.open_until = time.monotonic() - 1
+        await client.get("https://graph.microsoft.com/v1.0/me")
+        self.assertFalse(resilient.breaker.half_open_trial)
+        self.assertTrue(resilient.breaker.allow())
+
+    async def test_open_breaker_sheds_requests(self):
+        resilient, client = self.make_client(httpx.MockTransport(lambda request: httpx.Response(200)))
+        resilient.breaker.open_until = time.monotonic() + 30
+        response = await client.get("https://graph.microsoft.com/v1.0/me")
+        self.assertEqual(response.status_code, 503)
+        self.assertGreaterEqual(int(response.headers["Retry-After"]), 30)
+
+    async def test_throttling_does_not_feed_the_breaker(self):
+        resilient, client = self.make_client(
+            httpx.MockTransport(lambda request: httpx.Response(429, headers={"Retry-After": "0"}))
+        )
+        response = await client.get("https://graph.microsoft.com/v1.0/me", extensions={"graph_retries": 0})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(len(resilient.breaker.failures), 0)
+
+    async def test_one_failure_per_request_not_per_attempt(self):
+        attempts = []
+
+        def unavailable(request):
+            attempts.append(request)
+            return httpx.Response(503, headers={"Retry-After": "0"})
+
+        resilient, client = self.make_client(httpx.MockTransport(unavailable))
+        response = await client.get("https://graph.microsoft.com/v1.0/me", extensions={"graph_retries": 2})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(len(resilient.breaker.failures), 1)
+
+    async def test_retry_then_success(self):
+        responses = [httpx.Response(503, headers={"Retry-After": "0"}), httpx.Response(200, json={"id": "u1"})]
+        resilient, client = self.make_client(httpx.MockTransport(lambda request: responses.pop(0)))
+        response = await client.get("https://graph.microsoft.com/v1.0/me")
+        self.assertEqual(response.json(), {"id": "u1"})
+        self.assertEqual(len(resilient.breaker.failures), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
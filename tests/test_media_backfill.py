@@ -0,0 +1,58 @@
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from tests.server_support import AsyncMongoMockClient, server
+
+
+@unittest.skipIf(AsyncMongoMockClient is None, "mongomock-motor is not installed")
+class TestBackfillBackoff(unittest.IsolatedAsyncioTestCase):
+    """Items that keep failing are retried with exponential backoff, not on every sync"""
+
+    async def asyncSetUp(self):
+        self.db = AsyncMongoMockClient()["test"]
+        patcher = patch.object(server.app, "mongodb", self.db, create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.items = self.db["drive_items"]
+        await self.items.insert_one({"user_id": "u1", "id": "v1", "name": "a.mkv", "is_folder": False, "etag": "e1"})
+
+    async def pending_ids(self, now: datetime) -> list:
+        cursor = self.items.find(server.backfill_pending_query("u1", now), {"id": 1})
+        return [doc["id"] async for doc in cursor]
+
+    async def record_failure(self):
+        doc = await self.items.find_one({"id": "v1"})
+        await server.record_backfill_failure("u1", doc)
+        return await self.items.find_one({"id": "v1"})
+
+    async def test_failed_item_waits_out_its_backoff(self):
+        doc = await self.record_failure()
+        self.assertEqual(doc["backfill_attempts"], 1)
+        self.assertEqual(await self.pending_ids(datetime.utcnow()), [])
+        later = doc["backfill_next_attempt"] + timedelta(seconds=1)
+        self.assertEqual(await self.pending_ids(later), ["v1"])
+
+    async def test_backoff_doubles_per_failure(self):
+        first = await self.record_failure()
+        second = await self.record_failure()
+        self.assertEqual(second["backfill_attempts"], 2)
+        first_delay = first["backfill_next_attempt"] - datetime.utcnow()
+        second_delay = second["backfill_next_attempt"] - datetime.utcnow()
+        self.assertGreater(second_delay, first_delay * 1.9)
+
+    async def test_new_version_is_pending_again(self):
+        await self.record_failure()
+        await self.record_failure()
+        await self.items.update_one({"id": "v1"}, {"$set": {"etag": "e2"}})
+        self.assertEqual(await self.pending_ids(datetime.utcnow()), ["v1"])
+        doc = await self.record_failure()
+        self.assertEqual(doc["backfill_attempts"], 1)
+
+    async def test_covered_item_is_not_pending(self):
+        await self.items.update_one({"id": "v1"}, {"$set": {"backfill_etag": "e1"}})
+        self.assertEqual(await self.pending_ids(datetime.utcnow()), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
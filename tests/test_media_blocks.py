@@ -0,0 +1,65 @@
+import contextlib
+import unittest
+from unittest.mock import patch
+
+import httpx
+
+from tests.server_support import server
+
+
+class TestUpstreamRangeMatches(unittest.TestCase):
+    """Shared/cached blocks are only taken from replies that start at the requested offset"""
+
+    def test_partial_content_at_the_right_offset(self):
+        response = httpx.Response(206, headers={"Content-Range": "bytes 1048576-2097151/9999999"})
+        self.assertTrue(server.upstream_range_matches(response, 1048576))
+
+    def test_partial_content_at_another_offset(self):
+        response = httpx.Response(206, headers={"Content-Range": "bytes 0-1048575/9999999"})
+        self.assertFalse(server.upstream_range_matches(response, 1048576))
+
+    def test_partial_content_without_content_range(self):
+        self.assertFalse(server.upstream_range_matches(httpx.Response(206), 1048576))
+
+    def test_ignored_range_only_serves_the_first_block(self):
+        self.assertTrue(server.upstream_range_matches(httpx.Response(200), 0))
+        self.assertFalse(server.upstream_range_matches(httpx.Response(200), 1048576))
+
+    def test_error_status(self):
+        self.assertFalse(server.upstream_range_matches(httpx.Response(416), 0))
+
+
+class Body(httpx.AsyncByteStream):
+    def __init__(self, data: bytes):
+        self.data = data
+
+    async def __aiter__(self):
+        yield self.data
+
+
+class TestFetchMediaWindow(unittest.IsolatedAsyncioTestCase):
+    """Probe windows are never taken from the wrong offset of the file"""
+
+    async def fetch(self, response: httpx.Response, start: int, length: int) -> bytes:
+        @contextlib.asynccontextmanager
+        async def open_stream(*args, **kwargs):
+            yield response
+
+        with patch.object(server, "open_download_stream", open_stream), \
+                patch.object(server.app, "media_client", None, create=True):
+            return await server.fetch_media_window("token", "item", "https://cdn/x", start, length)
+
+    async def test_partial_content(self):
+        response = httpx.Response(206, headers={"Content-Range": "bytes 4-7/10"}, stream=Body(b"4567"))
+        self.assertEqual(await self.fetch(response, 4, 4), b"4567")
+
+    async def test_ignored_range_at_the_start(self):
+        self.assertEqual(await self.fetch(httpx.Response(200, stream=Body(b"0123456789")), 0, 4), b"0123")
+
+    async def test_ignored_range_past_the_start(self):
+        with self.assertRaises(RuntimeError):
+            await self.fetch(httpx.Response(200, stream=Body(b"0123456789")), 4, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
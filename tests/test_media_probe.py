@@ -0,0 +1,124 @@
+import struct
+import unittest
+
+from tests.server_support import server
+
+
+def box(box_type: bytes, payload: bytes) -> bytes:
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def full_box(box_type: bytes, payload: bytes, version: int = 0) -> bytes:
+    return box(box_type, bytes([version, 0, 0, 0]) + payload)
+
+
+def mp4_track(handler: bytes, fourcc: bytes, width: int = 0, height: int = 0, sample_table: bytes = b"") -> bytes:
+    tkhd = full_box(b"tkhd", b"\0" * 72 + struct.pack(">II", width << 16, height << 16))
+    mdhd = full_box(b"mdhd", struct.pack(">IIII", 0, 0, 24, 600) + b"\0" * 4)
+    hdlr = full_box(b"hdlr", b"\0" * 4 + handler + b"\0" * 12)
+    stsd = full_box(b"stsd", struct.pack(">I", 1) + box(fourcc, b"\0" * 70))
+    return box(b"trak", tkhd + box(b"mdia", mdhd + hdlr + box(b"minf", box(b"stbl", stsd + sample_table))))
+
+
+def ebml_element(element_id: int, payload: bytes) -> bytes:
+    """An element with an 8-byte size field, as muxers write for elements they patch later"""
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, "big") + b"\x01" + len(payload).to_bytes(7, "big") + payload
+
+
+class TestMp4Moov(unittest.TestCase):
+    """Codec/duration summary and keyframe index from an MP4 moov box"""
+
+    def setUp(self):
+        # 24 fps (timescale 24) for 600 samples, a keyframe every 48 samples
+        syncs = list(range(1, 601, 48))
+        sample_table = (
+            full_box(b"stts", struct.pack(">III", 1, 600, 1))
+            + full_box(b"stss", struct.pack(">I", len(syncs)) + b"".join(struct.pack(">I", n) for n in syncs))
+        )
+        mvhd = full_box(b"mvhd", struct.pack(">IIII", 0, 0, 1000, 5_400_000) + b"\0" * 80)
+        self.moov = (
+            mvhd
+            + mp4_track(b"vide", b"avc1", 1920, 1080, sample_table)
+            + mp4_track(b"soun", b"mp4a")
+            + mp4_track(b"sbtl", b"tx3g")
+        )
+
+    def test_summary(self):
+        summary = server.parse_mp4_moov(self.moov)
+        self.assertEqual(summary["duration"], 5400)
+        self.assertEqual(summary["video_codec"], "h264")
+        self.assertEqual(summary["audio_codec"], "aac")
+        self.assertEqual((summary["width"], summary["height"]), (1920, 1080))
+        self.assertTrue(summary["has_subtitles"])
+        self.assertEqual(summary["container"], "mp4")
+
+    def test_truncated_moov_does_not_raise(self):
+        summary = server.parse_mp4_moov(self.moov[:200])
+        self.assertEqual(summary["duration"], 5400)
+
+    def test_keyframe_times(self):
+        times = server.mp4_keyframe_times(self.moov)
+        self.assertEqual(times[:3], [0.0, 2.0, 4.0])
+        self.assertEqual(len(times), 13)
+
+    def test_no_sync_sample_table(self):
+        moov = full_box(b"mvhd", struct.pack(">IIII", 0, 0, 1000, 1000) + b"\0" * 80) + mp4_track(b"vide", b"avc1")
+        self.assertEqual(server.mp4_keyframe_times(moov), [])
+
+
+class TestEbml(unittest.TestCase):
+    """EBML variable-length integers and the Matroska header parser"""
+
+    def test_vint_lengths(self):
+        self.assertEqual(server.read_ebml_vint(b"\x81", 0), (1, 1))
+        self.assertEqual(server.read_ebml_vint(b"\x40\x02", 0), (2, 2))
+        self.assertEqual(server.read_ebml_vint(b"\x00\x81", 1), (1, 1))
+
+    def test_vint_unknown_size(self):
+        self.assertEqual(server.read_ebml_vint(b"\xff", 0), (None, 1))
+        self.assertEqual(server.read_ebml_vint(b"\x01\xff\xff\xff\xff\xff\xff\xff", 0), (None, 8))
+
+    def test_element_id_keeps_marker(self):
+        self.assertEqual(server.read_ebml_vint(b"\x1a\x45\xdf\xa3", 0, keep_marker=True), (0x1A45DFA3, 4))
+
+    def test_invalid_vint(self):
+        with self.assertRaises(ValueError):
+            server.read_ebml_vint(b"\x00", 0)
+
+    def test_matroska_header(self):
+        video = ebml_element(0xAE, (
+            ebml_element(0x83, b"\x01")
+            + ebml_element(0x86, b"V_MPEGH/ISO/HEVC")
+            + ebml_element(0xE0, ebml_element(0xB0, (3840).to_bytes(2, "big")) + ebml_element(0xBA, (2160).to_bytes(2, "big")))
+        ))
+        audio = ebml_element(0xAE, ebml_element(0x83, b"\x02") + ebml_element(0x86, b"A_EAC3"))
+        subtitles = ebml_element(0xAE, ebml_element(0x83, b"\x11") + ebml_element(0x86, b"S_TEXT/UTF8"))
+        info = ebml_element(0x1549A966, (
+            ebml_element(0x2AD7B1, (1_000_000).to_bytes(3, "big")) + ebml_element(0x4489, struct.pack(">d", 7_200_000.0))
+        ))
+        head = (
+            ebml_element(0x1A45DFA3, ebml_element(0x4282, b"webm"))
+            # Segment of unknown size, as live muxers write it
+            + bytes.fromhex("18538067") + b"\x01\xff\xff\xff\xff\xff\xff\xff"
+            + info
+            + ebml_element(0x1654AE6B, video + audio + subtitles)
+            + ebml_element(0x1F43B675, b"\0" * 64)
+        )
+
+        summary = server.parse_matroska_header(head)
+        self.assertEqual(summary["container"], "webm")
+        self.assertEqual(summary["duration"], 7200)
+        self.assertEqual(summary["video_codec"], "hevc")
+        self.assertEqual((summary["width"], summary["height"]), (3840, 2160))
+        self.assertEqual(summary["audio_codec"], "eac3")
+        self.assertTrue(summary["has_subtitles"])
+
+    def test_not_matroska(self):
+        self.assertIsNone(server.parse_matroska_header(ebml_element(0x4282, b"webm")))
+
+    def test_header_without_segment(self):
+        self.assertIsNone(server.parse_matroska_header(ebml_element(0x1A45DFA3, ebml_element(0x4282, b"webm"))))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest.mock import AsyncMock, patch
+
+from tests.server_support import server
+
+
+class TestRemuxPrune(unittest.IsolatedAsyncioTestCase):
+    """Pruned remux outputs must not leave "done" jobs pointing at missing files"""
+
+    async def asyncSetUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        for name, value in (
+            ("REMUX_CACHE_DIR", self.cache_dir),
+            ("remux_jobs", {}),
+            ("remux_queue", server.asyncio.PriorityQueue()),
+            ("ffmpeg_available", lambda: True),
+            ("get_stream_file_info", AsyncMock(return_value={"eTag": '"e2"'})),
+        ):
+            patcher = patch.object(server, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        for name in os.listdir(self.cache_dir):
+            os.unlink(os.path.join(self.cache_dir, name))
+        os.rmdir(self.cache_dir)
+
+    def finished_job(self, item_id: str, etag: str, age: float = 0) -> server.RemuxJob:
+        job = server.RemuxJob(item_id, etag, "token", server.REMUX_PRIORITY_BACKGROUND)
+        job.status = "done"
+        with open(job.output_path, "wb") as f:
+            f.write(b"x" * 100)
+        os.utime(job.output_path, (time.time() - age, time.time() - age))
+        server.remux_jobs[job.key] = job
+        return job
+
+    async def test_prune_forgets_jobs_of_removed_outputs(self):
+        old = self.finished_job("old", '"e1"', age=60)
+        recent = self.finished_job("recent", '"e1"')
+
+        with patch.object(server, "REMUX_CACHE_MAX_BYTES", 150):
+            server.forget_remux_jobs(server.prune_remux_cache())
+
+        self.assertFalse(os.path.exists(old.output_path))
+        self.assertTrue(os.path.exists(recent.output_path))
+        self.assertEqual(list(server.remux_jobs), [recent.key])
+
+    async def test_done_job_without_output_is_queued_again(self):
+        stale = self.finished_job("X", '"e2"')
+        os.unlink(stale.output_path)
+
+        job = await server.ensure_remux_job("token", "X")
+        self.assertIsNot(job, stale)
+        self.assertEqual(job.status, "queued")
+        self.assertEqual(server.remux_queue.qsize(), 1)
+
+    async def test_existing_output_is_reused_and_touched(self):
+        kept = server.RemuxJob("X", '"e2"', "token", server.REMUX_PRIORITY_BACKGROUND)
+        with open(kept.output_path, "wb") as f:
+            f.write(b"x")
+        os.utime(kept.output_path, (0, 0))
+
+        job = await server.ensure_remux_job("token", "X")
+        self.assertEqual(job.status, "done")
+        self.assertGreater(os.path.getmtime(job.output_path), 0)
+        self.assertEqual(server.remux_queue.qsize(), 0)
+
+    async def test_finished_jobs_are_bounded(self):
+        jobs = [self.finished_job(f"item{index}", '"e1"') for index in range(3)]
+        with patch.object(server, "REMUX_MAX_JOBS", 2):
+            server.forget_remux_jobs()
+        self.assertEqual(list(server.remux_jobs), [jobs[1].key, jobs[2].key])
+
+
+class TestRemuxJobRun(unittest.IsolatedAsyncioTestCase):
+    """ffmpeg output is read while it runs, so a chatty job cannot block on its pipes"""
+
+    async def asyncSetUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        for name, value in (
+            ("REMUX_CACHE_DIR", cache_dir.name),
+            ("get_media_probe", AsyncMock(return_value={"duration": 10})),
+            ("get_stream_file_info", AsyncMock(return_value={"@microsoft.graph.downloadUrl": "https://cdn/x"})),
+        ):
+            patcher = patch.object(server, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def run_job(self, script: str) -> server.RemuxJob:
+        job = server.RemuxJob("X", '"e1"', "token", server.REMUX_PRIORITY_PLAYBACK)
+        with patch.object(server, "remux_args", lambda url, probe, path: [sys.executable, "-c", script]):
+            await asyncio.wait_for(server.run_remux_job(job), 10)
+        return job
+
+    async def test_large_stderr_does_not_block(self):
+        job = await self.run_job(
+            "import sys; sys.stderr.write('w' * 1_000_000 + 'last words'); sys.stderr.flush();"
+            "print('out_time_us=5000000', flush=True); sys.exit(1)"
+        )
+        self.assertEqual(job.status, "failed")
+        self.assertTrue(job.error.endswith("last words"))
+        self.assertEqual(job.progress, 0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()